@@ -4,62 +4,288 @@ and output the results to newline-delimited JSON files.
 """
 
 import asyncio
+import glob
+import multiprocessing
 import os
-from typing import Any, Dict, List
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import AsyncIterator, Dict, Iterator, List, Set, Tuple, Union
 
+import orjson
 import polars as pl
 from dotenv import load_dotenv
+from pydantic import TypeAdapter
+from tqdm import tqdm
 
 os.environ["BAML_LOG"] = "WARN"
 
 from baml_client.async_client import b
+from baml_py.errors import BamlValidationError
+from baml_client.types import Pii
 
 load_dotenv()
 
+# uvloop is optional: use its faster event loop when it is installed
+try:
+    import uvloop
+
+    loop_factory = uvloop.new_event_loop
+except ImportError:
+    loop_factory = None
+
 # Rate limiting configuration to avoid overwhelming the API (esp. for smaller/less popular models)
 MAX_CONCURRENT_REQUESTS = 20  # Adjust based on the API limit
-REQUEST_DELAY = 0.01  # Delay between individual API calls in seconds
+BATCH_SIZE = 1  # Max number of records sent per LLM call (batching is opt-in via --batch-size)
+MAX_BATCH_CHARS = 8000  # Max characters of input text per batched call (~2k tokens at ~4 chars/token)
+
+# Serializes Pii results straight to JSON bytes, without building an intermediate dict
+pii_adapter = TypeAdapter(Pii)
+
+# Extracted PII for a record, or the error message if extraction failed
+Result = Union[Pii, str]
 
 # Global semaphore to limit concurrent API requests
 api_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
 
-async def extract_pii(record: Dict[str, Any]) -> Dict[str, Any]:
+def to_ndjson_row(record_id: int, result: Result) -> bytes:
+    "Serialize a result as an NDJSON row, splicing record_id in as the first key"
+    if isinstance(result, str):
+        return orjson.dumps({"record_id": record_id, "error": result}, option=orjson.OPT_APPEND_NEWLINE)
+    return b'{"record_id":%d,%b\n' % (record_id, pii_adapter.dump_json(result)[1:])
+
+
+async def extract_pii(text: str) -> Pii:
+    async with api_semaphore:
+        return await b.ExtractPii(text)
+
+
+class BatchSizeMismatchError(ValueError):
+    "The LLM returned a different number of results than the texts in the batch"
+
+
+async def extract_pii_batch(batch: List[Tuple[int, str]]) -> List[Tuple[int, Result]]:
+    "Extract PII for several records with a single LLM call"
     async with api_semaphore:
-        await asyncio.sleep(REQUEST_DELAY)
-        pii = await b.ExtractPii(record["text"])
-        output = pii.model_dump()
-        output["record_id"] = record["record_id"]
-        print(f"✓ Extracted PII for record {record['record_id']}")
-        return output
+        piis = await b.ExtractPiiBatch([text for _, text in batch])
+    if len(piis) != len(batch):
+        raise BatchSizeMismatchError(f"Expected {len(batch)} results, got {len(piis)}")
+    return [(record_id, pii) for (record_id, _), pii in zip(batch, piis)]
 
 
-async def process_record(record: Dict[str, Any]) -> Dict[str, Any]:
+async def process_record(record_id: int, text: str) -> Tuple[int, Result]:
     try:
-        return await extract_pii(record)
+        return record_id, await extract_pii(text)
     except Exception as e:
-        print(f"❌ Error processing record {record['record_id']}: {e}")
-        return {"record_id": record["record_id"], "error": str(e)}
+        tqdm.write(f"❌ Error processing record {record_id}: {e}")
+        return record_id, str(e)
 
 
-async def extract(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    print(f"Processing {len(records)} records")
-    tasks = [process_record(record) for record in records]
-    results = await asyncio.gather(*tasks)
-    return results
+async def process_batch(batch: List[Tuple[int, str]]) -> List[Tuple[int, Result]]:
+    if len(batch) == 1:
+        return [await process_record(*batch[0])]
+    record_ids = [record_id for record_id, _ in batch]
+    try:
+        return await extract_pii_batch(batch)
+    except (BamlValidationError, BatchSizeMismatchError) as e:
+        # Fall back to one call per record so a single bad parse doesn't lose the whole batch
+        tqdm.write(f"❌ Error parsing batch {record_ids}, retrying records individually: {e}")
+        return list(await asyncio.gather(*(process_record(*record) for record in batch)))
+    except Exception as e:
+        # Other failures (e.g., auth or bad requests) have already been retried by the client
+        # and would fail the same way for each record, so they aren't retried one by one
+        tqdm.write(f"❌ Error processing batch {record_ids}: {e}")
+        return [(record_id, str(e)) for record_id in record_ids]
+
+
+def make_batches(records: List[Tuple[int, str]], batch_size: int) -> Iterator[List[Tuple[int, str]]]:
+    "Group records into batches of up to batch_size records and MAX_BATCH_CHARS characters of text"
+    batch = []
+    batch_chars = 0
+    for record in records:
+        text_chars = len(record[1])
+        if batch and (len(batch) == batch_size or batch_chars + text_chars > MAX_BATCH_CHARS):
+            yield batch
+            batch = []
+            batch_chars = 0
+        batch.append(record)
+        batch_chars += text_chars
+    if batch:
+        yield batch
+
+
+async def extract(
+    records: List[Tuple[int, str]], batch_size: int = BATCH_SIZE
+) -> AsyncIterator[Tuple[int, Result]]:
+    "Yield (record_id, result) pairs as they complete, keeping at most MAX_CONCURRENT_REQUESTS batches in flight"
+    batches = make_batches(records, batch_size)
+    pending = set()
+    while True:
+        for batch in batches:
+            pending.add(asyncio.create_task(process_batch(batch)))
+            if len(pending) >= MAX_CONCURRENT_REQUESTS:
+                break
+        if not pending:
+            break
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            for record_result in task.result():
+                yield record_result
+
+
+def load_records(fname: str, start: int, end: int) -> List[Tuple[int, str]]:
+    "Load the requested window of records from the parquet file as (record_id, text) pairs"
+    # Slice before converting to Python objects so only the requested rows are materialized
+    df = (
+        pl.scan_parquet(fname)
+        .with_row_index("record_id", offset=1)
+        .slice(start - 1, end - start + 1)
+        .select("record_id", "text")
+        # Longest texts first, so slow requests don't straggle at the end of the run
+        .sort(pl.col("text").str.len_chars(), descending=True)
+        .collect()
+    )
+    return list(zip(df["record_id"].to_list(), df["text"].to_list()))
+
 
+def dedupe_records(records: List[Tuple[int, str]]) -> Tuple[List[Tuple[int, str]], Dict[int, List[int]]]:
+    "Keep the first record for each distinct text, and map its record_id to those of its duplicates"
+    first_ids: Dict[str, int] = {}
+    unique_records = []
+    duplicates = defaultdict(list)
+    for record_id, text in records:
+        if text in first_ids:
+            duplicates[first_ids[text]].append(record_id)
+        else:
+            first_ids[text] = record_id
+            unique_records.append((record_id, text))
+    return unique_records, dict(duplicates)
 
-async def main(fname: str, start: int, end: int) -> None:
+
+async def write_results(
+    records: List[Tuple[int, str]],
+    batch_size: int,
+    output_path: str,
+    duplicates: Dict[int, List[int]],
+    position: int = 0,
+) -> int:
+    "Append extracted PII to a newline-delimited JSON file and return the number of rows written"
+    count = 0
+    # Rows are written in completion order; evaluate.py matches them by record_id
+    with (
+        open(output_path, "ab") as f,
+        tqdm(total=len(records), unit="record", position=position) as progress,
+    ):
+        async for record_id, result in extract(records, batch_size):
+            for row_id in (record_id, *duplicates.get(record_id, ())):
+                f.write(to_ndjson_row(row_id, result))
+                count += 1
+            # Flush every row so an interrupted run keeps everything completed so far
+            f.flush()
+            progress.update(1)
+    return count
+
+
+def run_shard(
+    records: List[Tuple[int, str]],
+    batch_size: int,
+    output_path: str,
+    duplicates: Dict[int, List[int]],
+    position: int,
+) -> int:
+    "Run one shard of records on its own event loop in a worker process"
+    return asyncio.run(
+        write_results(records, batch_size, output_path, duplicates, position),
+        loop_factory=loop_factory,
+    )
+
+
+def merge_shards(shard_paths: List[str], partial_path: str) -> None:
+    "Append the shard files to the partial output file and remove them"
+    with open(partial_path, "ab") as f:
+        for shard_path in shard_paths:
+            with open(shard_path, "rb") as shard:
+                shutil.copyfileobj(shard, f)
+            os.remove(shard_path)
+
+
+def run_sharded(
+    records: List[Tuple[int, str]],
+    batch_size: int,
+    output_path: str,
+    partial_path: str,
+    duplicates: Dict[int, List[int]],
+    workers: int,
+) -> int:
+    "Split records across worker processes and merge their outputs into the partial file"
+    # Strided shards keep each worker's records in longest-first order with a similar mix of lengths.
+    # Each worker has its own semaphore, so up to workers * MAX_CONCURRENT_REQUESTS calls can be in flight.
+    shards = [records[i::workers] for i in range(workers)]
+    shard_paths = [f"{output_path}.shard{i}" for i in range(workers)]
+    # Spawn rather than fork, since the BAML runtime has already started background threads
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        counts = list(
+            executor.map(run_shard, shards, repeat(batch_size), shard_paths, repeat(duplicates), range(workers))
+        )
+    merge_shards(shard_paths, partial_path)
+    return sum(counts)
+
+
+def load_completed(output_path: str, partial_path: str) -> Set[int]:
+    "Collect the successful rows of a previous run into the partial file and return their record_ids"
+    if not os.path.exists(partial_path) and os.path.exists(output_path):
+        shutil.copyfile(output_path, partial_path)
+    # Shard files are left behind when a multi-worker run is interrupted
+    merge_shards(sorted(glob.glob(f"{glob.escape(output_path)}.shard*")), partial_path)
+
+    completed = set()
+    rows = []
+    with open(partial_path, "rb") as f:
+        for line in f:
+            try:
+                row = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # Row cut off by an interrupted write
+            # Error rows are dropped so those records are retried
+            if "error" not in row:
+                completed.add(row["record_id"])
+                rows.append(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+    with open(partial_path, "wb") as f:
+        f.writelines(rows)
+    return completed
+
+
+def main(
+    fname: str, start: int, end: int, batch_size: int, output_path: str, workers: int, resume: bool
+) -> None:
     "Run the information extraction workflow"
-    df = pl.read_parquet(fname)
-    df = df.with_row_index("record_id", offset=1)
-    records = df.to_dicts()
-    records = records[start - 1 : end]
+    records = load_records(fname, start, end)
+    # Results go to a partial file that only replaces output_path once the run completes
+    partial_path = f"{output_path}.partial"
+    if resume:
+        completed = load_completed(output_path, partial_path)
+        remaining = [record for record in records if record[0] not in completed]
+        print(f"Resuming: skipping {len(records) - len(remaining)} already extracted records")
+        records = remaining
+    else:
+        # Start from scratch, discarding leftovers from an interrupted run
+        open(partial_path, "wb").close()
+        for shard_path in glob.glob(f"{glob.escape(output_path)}.shard*"):
+            os.remove(shard_path)
+    # Records with identical text are only sent to the LLM once
+    records, duplicates = dedupe_records(records)
+    print(f"Processing {len(records)} records...")
 
-    results = await extract(records)
-    results = sorted(results, key=lambda x: x["record_id"])
-    results_df = pl.DataFrame(results)
-    results_df.write_ndjson(args.output)
+    if workers == 1:
+        num_results = asyncio.run(
+            write_results(records, batch_size, partial_path, duplicates), loop_factory=loop_factory
+        )
+    else:
+        num_results = run_sharded(records, batch_size, output_path, partial_path, duplicates, workers)
+    os.replace(partial_path, output_path)
+    print(f"\nCompleted processing {num_results} records and saved to {output_path}")
 
 
 if __name__ == "__main__":
@@ -82,8 +308,40 @@ if __name__ == "__main__":
         default="../data/structured_output_baml.json",
         help="Output file name",
     )
+    parser.add_argument(
+        "--batch-size",
+        "-b",
+        type=int,
+        default=BATCH_SIZE,
+        help="Max number of records per LLM call",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of worker processes, each running its own event loop",
+    )
+    parser.add_argument(
+        "--resume",
+        "-r",
+        action="store_true",
+        help="Skip records already extracted to the output file by a previous or interrupted run",
+    )
     args = parser.parse_args()
-    if args.start < 1:
-        raise ValueError("Start index must be 1 or greater")
+    if args.start < 1 or args.start > args.end:
+        raise ValueError("Start index must be 1 or greater and <= end index.")
+    if args.batch_size < 1:
+        raise ValueError("Batch size must be 1 or greater")
+    if args.workers < 1:
+        raise ValueError("Number of workers must be 1 or greater")
 
-    asyncio.run(main(args.fname, start=args.start, end=args.end))
+    main(
+        args.fname,
+        start=args.start,
+        end=args.end,
+        batch_size=args.batch_size,
+        output_path=args.output,
+        workers=args.workers,
+        resume=args.resume,
+    )
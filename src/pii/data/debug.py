@@ -3,8 +3,8 @@ Debug script to compare a single record between the source and result FHIR data.
 """
 import polars as pl
 
-df = pl.read_parquet("pii.parquet")
-print(len(df))
+lf = pl.scan_parquet("pii.parquet")
+print(lf.select(pl.len()).collect().item())
 
 # pprint(result_data[INDEX_ID - 1])
-print(df.filter(pl.col("ground_truth").str.contains("Manley")).select(pl.all()).to_dicts())
+print(lf.filter(pl.col("ground_truth").str.contains("Manley", literal=True)).collect().to_dicts())
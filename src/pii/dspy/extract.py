@@ -5,28 +5,49 @@ and output the results to newline-delimited JSON files.
 
 import argparse
 import asyncio
-import json
+import glob
+import multiprocessing
 import os
-from typing import Any
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import AsyncIterator
 
 import dspy
+import orjson
 import polars as pl
 from dotenv import load_dotenv
 from dspy.adapters.baml_adapter import BAMLAdapter  # noqa: E402
+from pydantic import TypeAdapter
+from tqdm import tqdm
 
 from schema import PII
 
 load_dotenv()
 
+try:
+    import uvloop
+
+    loop_factory = uvloop.new_event_loop
+except ImportError:
+    loop_factory = None
+
 # Using OpenRouter. Switch to another LLM provider as needed
+# Responses are cached on disk so re-running overlapping --start/--end windows doesn't
+# re-query the API. Set cache=False when benchmarking so every run hits the LM.
 lm = dspy.LM(
     model="openrouter/google/gemini-3-flash-preview",
     api_base="https://openrouter.ai/api/v1",
     api_key=os.environ["OPENROUTER_API_KEY"],
-    cache=False,
+    cache=True,
+    # Retry failed LM calls (e.g., rate limits and transient provider errors) with exponential backoff
+    num_retries=5,
 )
 dspy.configure(lm=lm)
 
+MAX_CONCURRENT_REQUESTS = 20  # Adjust based on the API limit
+
 
 class PIIInfo(dspy.Signature):
     """
@@ -38,37 +59,176 @@ class PIIInfo(dspy.Signature):
     pii: PII = dspy.OutputField()
 
 
+# Serializes PII results straight to JSON bytes, without building an intermediate dict
+pii_adapter = TypeAdapter(PII)
+
+
+def to_ndjson_row(record_id: int, pii: PII) -> bytes:
+    """Serialize a result as an NDJSON row, splicing record_id in as the first key."""
+    return b'{"record_id":%d,%b\n' % (record_id, pii_adapter.dump_json(pii)[1:])
+
+
 class ExtractPII(dspy.Module):
     def __init__(self):
         self.extract_pii = dspy.Predict(PIIInfo)
 
-    async def aforward(self, record: dict[str, Any]) -> dict[str, Any]:
-        result = await self.extract_pii.acall(text=record["text"])
-        output = result.pii.model_dump(mode="json")
-        output["record_id"] = record["record_id"]
-        return output
+    async def aforward(self, text: str) -> PII:
+        result = await self.extract_pii.acall(text=text)
+        return result.pii
+
+    def forward(self, text: str) -> PII:
+        result = self.extract_pii(text=text)
+        return result.pii
+
+
+# Build the module once and reuse it across all records and calls
+pii_extractor = ExtractPII()
+
+
+async def extract_record(record_id: int, text: str) -> tuple[int, PII]:
+    """Extract PII from a single record, keeping its record_id alongside the result."""
+    return record_id, await pii_extractor.aforward(text)
+
+
+async def extract_pii_async(records: list[tuple[int, str]]) -> AsyncIterator[tuple[int, PII]]:
+    """Extract PII from multiple records concurrently, yielding (record_id, PII) pairs as they complete."""
+    record_iter = iter(records)
+    pending = set()
+    while True:
+        for record in record_iter:
+            pending.add(asyncio.create_task(extract_record(*record)))
+            if len(pending) >= MAX_CONCURRENT_REQUESTS:
+                break
+        if not pending:
+            break
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            yield task.result()
+
+
+def load_records(fname: str, start: int, end: int) -> list[tuple[int, str]]:
+    """Load the requested window of records, longest texts first, as (record_id, text) pairs."""
+    df = (
+        pl.scan_parquet(fname)
+        .with_row_index("record_id", offset=1)
+        .slice(start - 1, end - start + 1)
+        .select("record_id", "text")
+        .sort(pl.col("text").str.len_chars(), descending=True)
+        .collect()
+    )
+    return list(zip(df["record_id"].to_list(), df["text"].to_list()))
+
 
-    def forward(self, record: dict[str, Any]) -> dict[str, Any]:
-        result = self.extract_pii(text=record["text"])
-        output = result.pii.model_dump(mode="json")
-        output["record_id"] = record["record_id"]
-        return output
+def dedupe_records(records: list[tuple[int, str]]) -> tuple[list[tuple[int, str]], dict[int, list[int]]]:
+    """Keep the first record for each distinct text, and map its record_id to those of its duplicates."""
+    first_ids: dict[str, int] = {}
+    unique_records = []
+    duplicates = defaultdict(list)
+    for record_id, text in records:
+        if text in first_ids:
+            duplicates[first_ids[text]].append(record_id)
+        else:
+            first_ids[text] = record_id
+            unique_records.append((record_id, text))
+    return unique_records, dict(duplicates)
 
 
-async def extract_pii_async(records: list[dict[str, Any]]) -> list[dict[str, Any]]:
-    """Extract PII from multiple records concurrently."""
+async def write_results(
+    records: list[tuple[int, str]],
+    output_path: str,
+    duplicates: dict[int, list[int]],
+    position: int = 0,
+) -> int:
+    """Append extracted records to newline-delimited JSON and return the number of rows written."""
+    count = 0
+    with (
+        open(output_path, "ab") as f,
+        tqdm(total=len(records), unit="record", position=position) as progress,
+    ):
+        async for record_id, pii in extract_pii_async(records):
+            for row_id in (record_id, *duplicates.get(record_id, ())):
+                f.write(to_ndjson_row(row_id, pii))
+                count += 1
+            f.flush()
+            progress.update(1)
+    return count
 
-    extract_pii = ExtractPII()
 
-    async def extract_single_record(record: dict[str, Any]) -> dict[str, Any]:
-        extracted_data = await extract_pii.aforward(record)
-        print(f"Record {record['record_id']} completed")
-        return extracted_data
+def run_shard(
+    records: list[tuple[int, str]], output_path: str, duplicates: dict[int, list[int]], position: int
+) -> int:
+    """Run one shard of records on its own event loop in a worker process."""
+    return asyncio.run(write_results(records, output_path, duplicates, position), loop_factory=loop_factory)
 
-    tasks = [extract_single_record(record) for record in records]
-    results = await asyncio.gather(*tasks)
-    sorted_results = sorted(results, key=lambda x: x["record_id"])
-    return sorted_results
+
+def merge_shards(shard_paths: list[str], partial_path: str) -> None:
+    """Append the shard files to the partial output file and remove them."""
+    with open(partial_path, "ab") as f:
+        for shard_path in shard_paths:
+            with open(shard_path, "rb") as shard:
+                shutil.copyfileobj(shard, f)
+            os.remove(shard_path)
+
+
+def run_sharded(
+    records: list[tuple[int, str]],
+    output_path: str,
+    partial_path: str,
+    duplicates: dict[int, list[int]],
+    workers: int,
+) -> int:
+    """Split records across worker processes and merge their outputs into the partial file."""
+    shards = [records[i::workers] for i in range(workers)]
+    shard_paths = [f"{output_path}.shard{i}" for i in range(workers)]
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        counts = list(executor.map(run_shard, shards, shard_paths, repeat(duplicates), range(workers)))
+    merge_shards(shard_paths, partial_path)
+    return sum(counts)
+
+
+def load_completed(output_path: str, partial_path: str) -> set[int]:
+    """Merge the rows of a previous run into the partial file and return their record_ids."""
+    if not os.path.exists(partial_path) and os.path.exists(output_path):
+        shutil.copyfile(output_path, partial_path)
+    merge_shards(sorted(glob.glob(f"{glob.escape(output_path)}.shard*")), partial_path)
+
+    completed = set()
+    rows = []
+    with open(partial_path, "rb") as f:
+        for line in f:
+            try:
+                row = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # Truncated row
+            completed.add(row["record_id"])
+            rows.append(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+    with open(partial_path, "wb") as f:
+        f.writelines(rows)
+    return completed
+
+
+def main(fname: str, start: int, end: int, output_path: str, workers: int, resume: bool) -> None:
+    """Run the PII extraction workflow."""
+    records = load_records(fname, start, end)
+    partial_path = f"{output_path}.partial"
+    if resume:
+        completed = load_completed(output_path, partial_path)
+        remaining = [record for record in records if record[0] not in completed]
+        print(f"Resuming: skipping {len(records) - len(remaining)} already extracted records")
+        records = remaining
+    else:
+        open(partial_path, "wb").close()
+        for shard_path in glob.glob(f"{glob.escape(output_path)}.shard*"):
+            os.remove(shard_path)
+    records, duplicates = dedupe_records(records)
+    print(f"Processing {len(records)} records...")
+
+    if workers == 1:
+        num_results = asyncio.run(write_results(records, partial_path, duplicates), loop_factory=loop_factory)
+    else:
+        num_results = run_sharded(records, output_path, partial_path, duplicates, workers)
+    os.replace(partial_path, output_path)
+    print(f"\nCompleted processing {num_results} records and saved to {output_path}")
 
 
 if __name__ == "__main__":
@@ -89,18 +249,30 @@ if __name__ == "__main__":
         default="../data/structured_output_dspy.json",
         help="Output file name",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=1,
+        help="Number of worker processes, each running its own event loop",
+    )
+    parser.add_argument(
+        "--resume",
+        "-r",
+        action="store_true",
+        help="Skip records already extracted to the output file by a previous or interrupted run",
+    )
     args = parser.parse_args()
     if args.start < 1 or args.start > args.end:
         raise ValueError("Start index must be 1 or greater and <= end index.")
+    if args.workers < 1:
+        raise ValueError("Number of workers must be 1 or greater")
 
-    df = pl.read_parquet(args.fname)
-    df = df.with_row_index("record_id", offset=1)
-    records = df.to_dicts()
-    records = records[args.start - 1 : args.end]
-
-    print(f"Processing {len(records)} records...")
-    extracted_results = asyncio.run(extract_pii_async(records))
-    with open(args.output, "w") as f:
-        for record in extracted_results:
-            f.write(f"{json.dumps(record)}\n")
-    print(f"\nCompleted processing {len(extracted_results)} records and saved to {args.output}")
+    main(
+        args.fname,
+        start=args.start,
+        end=args.end,
+        output_path=args.output,
+        workers=args.workers,
+        resume=args.resume,
+    )